@@ -5,65 +5,171 @@
 #import logging
 import opensearchpy
 from opensearchpy import Search, A, Q
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
+import orjson
 import datetime
 import dateutil.relativedelta
-import operator
 import sys
 import os
 import requests
+import functools
 import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from statistics import mean
-from math import isclose
 
 
+class ORJSONSerializer(JSONSerializer):
+    """
+    JSONSerializer using orjson, which parses the large aggregation
+    responses several times faster than the stdlib json module.
+    """
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode()
+        except TypeError as e:
+            raise SerializationError(data, e)
+
 #logging.basicConfig(level=logging.WARN)
 es = opensearchpy.OpenSearch(
         ['https://gracc.opensciencegrid.org/q'],
         timeout=300, use_ssl=True, verify_certs=True,
-        ca_certs='/etc/ssl/certs/ca-bundle.crt')
+        ca_certs='/etc/ssl/certs/ca-bundle.crt',
+        http_compress=True, serializer=ORJSONSerializer())
+
+# Shared HTTP session for Topology requests
+http_session = requests.Session()
 
 osg_raw_index = 'gracc.osg.raw-*'
 osg_summary_index = 'gracc.osg.summary'
 
 vo_list = ['atlas', 'alice', 'belle', 'cms', 'enmr.eu', 'lhcb']
 
-MAXSZ=2**30
-MISSING='__MISSING__'
+# Buckets per page of the composite aggregation
+composite_size = 1000
 
 resource_group_map = None
 
-def get_hs23_portion(resource_group) -> float:
+# On-disk cache of the averaged {resource_group: hs23_portion} map from Topology.
+# The container is started with --rm, so the cache directory must be a
+# volume (see gracc-apel.service) for the cache to outlive a single run.
+resource_group_cache_dir = os.environ.get('GRACC_APEL_CACHE_DIR', '/var/cache/gracc-apel')
+resource_group_cache = os.path.join(resource_group_cache_dir, 'rg_map.json')
+resource_group_cache_ttl = 6*60*60
+# Never fall back to a cache older than this when Topology is unavailable
+resource_group_cache_max_stale = 7*24*60*60
+
+def load_resource_group_cache(max_age):
+    """
+    Load the cached resource group map, if present.
+
+    :param max_age: Maximum age of the cache in seconds.
+    :return: The cached map, or None if missing, expired, or unreadable.
+    """
+    try:
+        st = os.stat(resource_group_cache)
+        if time.time() - st.st_mtime > max_age:
+            return None
+        with open(resource_group_cache) as f:
+            rg_map = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(rg_map, dict):
+        return None
+    return rg_map
+
+def save_resource_group_cache(rg_map):
+    """
+    Atomically write the resource group map to the on-disk cache.
+    """
+    cache_dir = os.path.dirname(resource_group_cache)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError as e:
+        print("Unable to write resource group cache {}: {}".format(resource_group_cache, e), file=sys.stderr)
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(rg_map, f)
+        os.replace(tmp_path, resource_group_cache)
+    except OSError as e:
+        os.unlink(tmp_path)
+        print("Unable to write resource group cache {}: {}".format(resource_group_cache, e), file=sys.stderr)
+
+def download_resource_group_map():
+    """
+    Download the resource group summary from Topology and average the
+    HS23 percentages of each resource group.
+
+    :return: The {resource_group: hs23_portion} map.
+    """
+    resp = http_session.get("https://topology.opensciencegrid.org/api/resource_group_summary",
+                            timeout=30)
+    if resp.status_code != 200:
+        raise Exception("Error downloading resource group summary from Topology: {}".format(resp.status_code))
+
+    raw_json = resp.json()
+    # Parse the JSON response
+    rg_map = {}
+    for resource_group_name in raw_json:
+        hep_spec_percentages = []
+        for resource in raw_json[resource_group_name]["Resources"]['Resource']:
+            if 'HEPScore23Percentage' in resource['WLCGInformation']:
+                hep_spec_percentages.append(float(resource['WLCGInformation']['HEPScore23Percentage']))
+        if len(hep_spec_percentages) > 0:
+            rg_map[resource_group_name] = mean(hep_spec_percentages)
+        else:
+            rg_map[resource_group_name] = 0.0
+    return rg_map
+
+def load_resource_group_map():
     """
     Download the HS23 portion of the OSG site info from OIM.
 
-    :param resource_group: The Topology resource group name.
-    :return: The HS23 portion of the site, or 0.0 if not found.
+    The parsed map is cached on disk for resource_group_cache_ttl seconds;
+    if Topology is unavailable, a stale cache up to
+    resource_group_cache_max_stale seconds old is used instead.
+
+    :return: The {resource_group: hs23_portion} map.
     """
     global resource_group_map
     if resource_group_map == None:
-        # Download the map from Topology
-        resp = requests.get("https://topology.opensciencegrid.org/api/resource_group_summary")
-        if resp.status_code != 200:
-            #print("Error downloading resource group summary from Topology: {}".format(resp.status_code))
-            #return 0.0
-            raise Exception("Error downloading resource group summary from Topology: {}".format(resp.status_code))
-        
-        raw_json = resp.json()
-        # Parse the JSON response
-        resource_group_map = {}
-        for resource_group_name in raw_json:
-            hep_spec_percentages = []
-            for resource in raw_json[resource_group_name]["Resources"]['Resource']:
-                if 'HEPScore23Percentage' in resource['WLCGInformation']:
-                    hep_spec_percentages.append(float(resource['WLCGInformation']['HEPScore23Percentage']))
-            if len(hep_spec_percentages) > 0:
-                resource_group_map[resource_group_name] = mean(hep_spec_percentages)
-            else:
-                resource_group_map[resource_group_name] = 0.0
+        resource_group_map = load_resource_group_cache(resource_group_cache_ttl)
+    if resource_group_map == None:
+        try:
+            resource_group_map = download_resource_group_map()
+        except Exception as e:
+            resource_group_map = load_resource_group_cache(resource_group_cache_max_stale)
+            if resource_group_map == None:
+                raise
+            age = time.time() - os.stat(resource_group_cache).st_mtime
+            print("WARNING: {}; using HS23 portions from stale cache {} ({:.1f} hours old)"
+                  .format(e, resource_group_cache, age / 3600), file=sys.stderr)
+        else:
+            save_resource_group_cache(resource_group_map)
+    return resource_group_map
 
-    return resource_group_map.get(resource_group, 0.0)
-        
+def get_hs23_portion(resource_group) -> float:
+    """
+    Look up the HS23 portion of a resource group.
 
+    :param resource_group: The Topology resource group name.
+    :return: The HS23 portion of the site, or 0.0 if not found.
+    """
+    return load_resource_group_map().get(resource_group, 0.0)
 
 
 def add_bkt_metrics(bkt):
@@ -77,38 +183,85 @@ def add_bkt_metrics(bkt):
     bkt = bkt.metric('LatestEndTime',      'max', field='EndTime')
     return bkt
 
-def gracc_query_apel(year, month):
+def gracc_query_apel(year, month, vo):
+    """
+    Query the month's summary records for one APEL VO.
+
+    Each composite aggregation is paged through with after_key, so the
+    buckets arrive composite_size at a time instead of as one enormous
+    nested terms response.  Records with an OIM_ResourceGroup are keyed
+    on it; the remaining records fall back to their SiteName.
+
+    :return: Generator of composite buckets keyed on Cores, VO, DN, Site.
+    """
     index = osg_summary_index
     starttime = datetime.datetime(year, month, 1)
     onemonth = dateutil.relativedelta.relativedelta(months=1)
     endtime = starttime + onemonth
     s = Search(using=es, index=index)
+    # Most selective clause first
     s = s.query('bool',
         filter=[
-            Q('range', EndTime={'gte': starttime, 'lt': endtime })
-          & Q('terms', VOName=vo_list)
-          & ( Q('term', ResourceType='Batch')
+            Q('term', VOName=vo),
+            Q('range', EndTime={'gte': starttime, 'lt': endtime }),
+            ( Q('term', ResourceType='Batch')
             | ( Q('term', ResourceType='Payload')
               & Q('term', Grid='Local') )
             )
         ]
     )
+    s = s.extra(size=0)
+
+    # Records with an OIM_ResourceGroup and the SiteName fallback are
+    # scanned separately, so a SiteName equal to a resource group name
+    # stays in its own bucket; add_record combines them per bucket.
+    has_rg = Q('exists', field='OIM_ResourceGroup')
+    for site_filter, site_field in [(has_rg, 'OIM_ResourceGroup'),
+                                    (~has_rg, 'SiteName')]:
+        sources = [
+            {'Cores': A('terms', field='Processors')},
+            {'VO':    A('terms', field='VOName')},
+            {'DN':    A('terms', field='DN')},
+            {'Site':  A('terms', field=site_field)},
+        ]
+        yield from scan_composite(s.filter(site_filter), sources)
 
-    bkt = s.aggs
-    bkt = bkt.bucket('Cores', 'terms', size=MAXSZ, field='Processors')
-    bkt = bkt.bucket('VO',    'terms', size=MAXSZ, field='VOName')
-    bkt = bkt.bucket('DN',    'terms', size=MAXSZ, field='DN')
-    bkt = bkt.bucket('Site',  'terms', size=MAXSZ, missing=MISSING, field='OIM_ResourceGroup')
-    #bkt = bkt.bucket('Site', 'terms', size=MAXSZ, field='SiteName')
-    #bkt = bkt.bucket('Site', 'terms', size=MAXSZ, field='WLCGAccountingName')
-    add_bkt_metrics(bkt)
-
-    bkt = bkt.bucket('SiteName',  'terms', size=MAXSZ, field='SiteName')
+def composite_page(s, sources, after=None):
+    """
+    Build the Search for one page of the composite aggregation.
+    """
+    page = s._clone()
+    params = {'sources': sources, 'size': composite_size}
+    if after is not None:
+        params['after'] = after
+    add_bkt_metrics(page.aggs.bucket('apel', 'composite', **params))
+    return page
+
+def scan_composite(s, sources):
+    """
+    Page through a composite aggregation over sources with after_key.
 
-    add_bkt_metrics(bkt)
+    The next page is requested in the background as soon as the current
+    page's after_key is known, so its round trip overlaps with the caller
+    reducing the current page.  At most one page is in flight at a time.
 
-    response = s.execute()
-    return response
+    :param s: The Search to aggregate over.
+    :param sources: The composite aggregation sources.
+    :return: Generator of composite buckets, with add_bkt_metrics applied,
+             as the plain dicts from the response JSON.  Skipping the
+             AttrDict wrappers keeps the per-bucket reduce cheap.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(composite_page(s, sources).execute)
+        while future is not None:
+            agg = future.result().to_dict()['aggregations']['apel']
+            buckets = agg['buckets']
+            if len(buckets) < composite_size or 'after_key' not in agg:
+                future = None
+            else:
+                page = composite_page(s, sources, agg['after_key'])
+                future = executor.submit(page.execute)
+            yield from buckets
 
 # Fixed entries:
 fixed_header = "APEL-normalised-summary-message: v0.4"
@@ -117,88 +270,64 @@ fixed_infrastructure = "grid"
 fixed_nodecount = 1
 fixed_normalizationfactor = 12
 
-def normal_hepspec_table():
-    from os.path import join, dirname, abspath
-    normal_hepspec_path = join(dirname(abspath(__file__)), "normal_hepspec")
-    table = {}
-    for line in open(normal_hepspec_path):
-        if line.startswith('#'):
-            continue
-        tokens = line.split()
-        if len(tokens) != 2:
-            continue
-        site, nf = tokens
-        nf = float(nf)
-        table[site] = nf
-    return table
+normal_hepspec_path = Path(__file__).resolve().parent / "normal_hepspec"
+
+def normal_hepspec_table(path=normal_hepspec_path):
+    rows = ( line.split() for line in path.read_text().splitlines()
+             if not line.startswith('#') )
+    return { tokens[0]: float(tokens[1]) for tokens in rows if len(tokens) == 2 }
 
 nf_table = normal_hepspec_table()
 
 def norm_factor(bkt, site):
     nf_max = 200
     nf_default = 12
-    nf_values = [ b.key for b in bkt.NormalFactor.buckets if b.key > 0 ]
-    if len(nf_values) == 0:
+    # Count and sum the positive norm factors in one pass
+    nf_count = 0
+    nf_sum = 0
+    for b in bkt['NormalFactor']['buckets']:
+        if b['key'] > 0:
+            nf_count += 1
+            nf_sum += b['key']
+    if nf_count == 0:
         # XXX: *should* look up from table here, but the old script just
         #      used the default (12) when not found on OIM.
         # TODO: log
         nf = nf_default
-    elif len(nf_values) == 1:
+    elif nf_count == 1:
         # ok, normal case
-        nf = nf_values[0]
+        nf = nf_sum
     else:
         # oh weird, why more than one norm factor here?
         # TODO: log
-        nf = 1.0 * sum(nf_values) / len(nf_values)
+        nf = 1.0 * nf_sum / nf_count
 
     if nf >= nf_max:
         # out of range: do table lookup
-        # TODO: log
-        if site in nf_table:
-            # TODO: log
-            nf = nf_table[site]
-        else:
-            # TODO: log
-            nf = nf_default
+        # TODO: log whether the site was in the table
+        nf = nf_table.get(site, nf_default)
     return nf
 
-from collections import namedtuple, defaultdict
-
-class autodict(defaultdict):
-    def __init__(self,*other):
-        defaultdict.__init__(self, self.__class__, *other)
-    def __add__ (self, other):
-        return other
-    def __repr__(self):
-        return '%s(%s)' % (self.__class__.__name__, dict.__repr__(self))
+from collections import namedtuple
 
 RecordKey = namedtuple('RecordKey', ['vo', 'site', 'cores', 'dn'])
 Record = namedtuple('Record', ["mintime", "maxtime", "walldur", "cpudur",
                                "nf", "njobs"])
 
 def bkt_record(bkt, site):
-    mintime = int(bkt.EarliestEndTime.value / 1000)
-    maxtime = int(bkt.LatestEndTime.value / 1000)
-    walldur = int(bkt.WallDuration.value)
-    if bkt.CpuDuration_user.value == 0 and bkt.CpuDuration_system.value == 0:
-        cpudur = int(bkt.CpuDuration.value)
+    mintime = int(bkt['EarliestEndTime']['value'] / 1000)
+    maxtime = int(bkt['LatestEndTime']['value'] / 1000)
+    walldur = int(bkt['WallDuration']['value'])
+    cpudur_user   = bkt['CpuDuration_user']['value']
+    cpudur_system = bkt['CpuDuration_system']['value']
+    if cpudur_user == 0 and cpudur_system == 0:
+        cpudur = int(bkt['CpuDuration']['value'])
     else:
-        cpudur  = int(bkt.CpuDuration_user.value + bkt.CpuDuration_system.value)
+        cpudur  = int(cpudur_user + cpudur_system)
     nf      = norm_factor(bkt, site)
-    njobs   = int(bkt.NumberOfJobs.value)
+    njobs   = int(bkt['NumberOfJobs']['value'])
     return Record(mintime, maxtime, walldur, cpudur, nf, njobs)
 
-def record_adder(a,b):
-    mintime = min(a.mintime, b.mintime)
-    maxtime = max(a.maxtime, b.maxtime)
-    walldur = a.walldur + b.walldur
-    cpudur  = a.cpudur  + b.cpudur
-    nf      = min(a.nf, b.nf)
-    njobs   = a.njobs + b.njobs
-    return Record(mintime, maxtime, walldur, cpudur, nf, njobs)
-
-Record.__add__ = record_adder
-
 site_map = {
     'Crane':     'Nebraska',
     'Sandhills': 'Nebraska',
@@ -211,75 +340,162 @@ site_vo_map = {
     ('MIT_CMS', 'lhcb'): 'MIT_LHCb'
 }
 
-def add_record(recs, vo, site, cores, dn, bkt):
-    if site in site_map:
-        site = site_map[site]
+def combined_site_map():
+    """
+    Fold site_map and site_vo_map into a single (site, vo) -> site map,
+    so add_record needs one lookup per bucket instead of two.
+    """
+    sites = set(site_map) | { site for site, vo in site_vo_map }
+    vos = set(vo_list) | { vo for site, vo in site_vo_map }
+    combined = {}
+    for site in sites:
+        for vo in vos:
+            new_site = site_map.get(site, site)
+            new_site = site_vo_map.get((new_site, vo), new_site)
+            if new_site != site:
+                combined[(site, vo)] = new_site
+    return combined
+
+site_remap = combined_site_map()
 
-    if (site, vo) in site_vo_map:
-        site = site_vo_map[(site, vo)]
+def add_record(recs, vo, site, cores, dn, bkt):
+    site = site_remap.get((site, vo), site)
 
     rk  = RecordKey(vo, site, cores, dn)
     rec = bkt_record(bkt, site)
 
-    recs[rk] += rec
+    prev = recs.get(rk)
+    if prev is None:
+        recs[rk] = rec
+    else:
+        recs[rk] = Record(min(prev.mintime, rec.mintime),
+                          max(prev.maxtime, rec.maxtime),
+                          prev.walldur + rec.walldur,
+                          prev.cpudur  + rec.cpudur,
+                          min(prev.nf, rec.nf),
+                          prev.njobs + rec.njobs)
+
+def flatten_buckets(buckets):
+    """
+    Unpack the composite buckets from gracc_query_apel into flat rows.
+
+    :param buckets: The composite buckets of gracc_query_apel.
+    :return: Generator of (vo, site, cores, dn, bkt) leaf rows.
+    """
+    # The same VO, site and DN strings repeat across many buckets; intern
+    # them so the RecordKeys share one copy and compare by identity.
+    intern = sys.intern
+    for bkt in buckets:
+        key = bkt['key']
+        yield (intern(key['VO']), intern(key['Site']), key['Cores'],
+               intern(key['DN']), bkt)
+
+def reduce_records(rows):
+    """
+    Sum the leaf rows from flatten_buckets into one Record per RecordKey.
+    """
+    recs = {}
+    for vo, site, cores, dn, bkt in rows:
+        add_record(recs, vo, site, cores, dn, bkt)
+    return recs
+
+def vo_records(year, month, vo):
+    """
+    Query and reduce the month's records for a single VO.
+    """
+    return reduce_records(flatten_buckets(gracc_query_apel(year, month, vo)))
+
+def gracc_apel_records(year, month):
+    """
+    Query and reduce the month's records for every VO in vo_list.
+
+    Each VO is queried in its own thread and reduced into a private dict.
+    The VO is part of the RecordKey, so the per-VO dicts never share keys
+    and are merged without any locking.
+    """
+    recs = {}
+    with ThreadPoolExecutor(max_workers=len(vo_list)) as executor:
+        futures = [executor.submit(vo_records, year, month, vo)
+                   for vo in vo_list]
+        for future in futures:
+            recs.update(future.result())
+    return recs
 
 def print_header(output_file = sys.stdout):
     print(fixed_header, file=output_file)
 
-def print_rk_recr(year, month, rk, rec, output_file=sys.stdout):
+@functools.cache
+def month_year_lines(year, month):
+    """
+    :return: The report lines that are the same for every record of a month.
+    """
+    return (f"Month: {month:02d}\n"
+            f"Year: {year}\n"
+            f"Infrastructure: {fixed_infrastructure}\n")
+
+@functools.cache
+def submit_hosts(hs23_portion):
+    """
+    Split a record between the submit hosts by its HS23 portion.
+
+    With no hs23 portion, the submit host is just "hepspec-hosts"
+    With hs23 portion, it's both "hepspec-hosts" and "hepscore-hosts"
+
+    Sites share only a handful of distinct portions, so the split is
+    cached per portion rather than worked out again for every record.
+
+    :return: Tuple of (submit_host, metric_name, portion) for each host.
+    """
+    hosts = (("hepspec-hosts", "hepspec", 1.0 - hs23_portion),)
+    if hs23_portion:
+        hosts += (("hepscore-hosts", "HEPscore23", hs23_portion),)
+    return hosts
+
+def print_rk_recr(year, month, rk, rec, output_file=sys.stdout,
+                  hs23_by_site=None):
 
     if rk.dn == "N/A":
         dn = "generic %s user" % rk.vo
     else:
         dn = rk.dn
 
-    # With no hs23 portion, the submit host is just "hepspec-hosts"
-    # With hs23 portion, it's both "hepspec-hosts" and "hepscore-hosts"
-    submit_hosts = ["hepspec-hosts"]
     # Check the site name for the HS23 portion
-    hs23_portion = get_hs23_portion(rk.site)
-    if not isclose(hs23_portion, 0.0):
-        submit_hosts.append("hepscore-hosts")
-        
-    # Quick lambda to write the lines
-    write = lambda *line: print(*line, file=output_file)
-
-    for submit_host in range(len(submit_hosts)):
-        # Index 0 is hepspec-hosts, index 1 is hepscore-hosts
-        # Do some clever math to get the portion
-
-        if submit_host == 0:
-            portion = 1.0 - hs23_portion
-            metric_name = "hepspec"
-        elif submit_host == 1:
-            portion = hs23_portion
-            metric_name = "HEPscore23"
-        else:
-            raise ValueError(f"Invalid submit_host: {submit_host}")
-        
-        write("Site:",                   rk.site)
-        write("SubmitHost:",             submit_hosts[submit_host])
-        write("VO:",                     rk.vo)
-        write("EarliestEndTime:",        rec.mintime)
-        write("LatestEndTime:",          rec.maxtime + 60*60*24 - 1)
-        write("Month:",                  "%02d" % month)
-        write("Year:",                   year)
-        write("Infrastructure:",         fixed_infrastructure)
-        write("GlobalUserName:",         dn)
-        write("Processors:",             rk.cores)
-        write("NodeCount:",              fixed_nodecount)
-        write("WallDuration:",           int(rec.walldur * portion))
-        write("CpuDuration:",            int(rec.cpudur * portion))
-        write("NormalisedWallDuration:", "{" + metric_name + ": " + str(int(rec.walldur * rec.nf * portion)) + "}")
-        write("NormalisedCpuDuration:",  "{" + metric_name + ": " + str(int(rec.cpudur  * rec.nf * portion)) + "}")
-        write("NumberOfJobs:",           int(rec.njobs * portion))
-        write(fixed_separator)
-
-def bkt_key_lower(bkt):
-    return bkt.key.lower()
-
-def sorted_buckets(agg, key=operator.attrgetter('key')):
-    return sorted(agg.buckets, key=key)
+    if hs23_by_site is None:
+        hs23_by_site = load_resource_group_map()
+    hs23_portion = hs23_by_site.get(rk.site, 0.0)
+
+    # The normalised durations are shared by every submit host; only the
+    # portion differs
+    nwalldur = rec.walldur * rec.nf
+    ncpudur  = rec.cpudur  * rec.nf
+
+    # Everything but the submit host and the metrics is the same for every
+    # submit host, so format it once
+    site_line = f"Site: {rk.site}\nSubmitHost: "
+    rk_lines = (f"\nVO: {rk.vo}\n"
+                f"EarliestEndTime: {rec.mintime}\n"
+                f"LatestEndTime: {rec.maxtime + 60*60*24 - 1}\n"
+                f"{month_year_lines(year, month)}"
+                f"GlobalUserName: {dn}\n"
+                f"Processors: {rk.cores}\n"
+                f"NodeCount: {fixed_nodecount}\n")
+
+    # Collect the lines and hand them to output_file in a single write
+    out = []
+    write = out.append
+
+    for submit_host, metric_name, portion in submit_hosts(hs23_portion):
+        write(site_line)
+        write(submit_host)
+        write(rk_lines)
+        write(f"WallDuration: {int(rec.walldur * portion)}\n"
+              f"CpuDuration: {int(rec.cpudur * portion)}\n"
+              f"NormalisedWallDuration: {{{metric_name}: {int(nwalldur * portion)}}}\n"
+              f"NormalisedCpuDuration: {{{metric_name}: {int(ncpudur * portion)}}}\n"
+              f"NumberOfJobs: {int(rec.njobs * portion)}\n"
+              f"{fixed_separator}\n")
+
+    output_file.write(''.join(out))
 
 def auto_year_month():
     today = datetime.datetime.today()
@@ -301,32 +517,15 @@ def main():
             sys.exit(0)
 
     outfile_name = "%02d_%d.apel" % (month, year)
-    outfile = open(outfile_name, "w")
-
-    resp = gracc_query_apel(year, month)
-    aggs = resp.aggregations
-
-    recs = autodict()
-
-    print_header(outfile)
-    for cores_bkt in sorted_buckets(aggs.Cores):
-        cores = cores_bkt.key
-        for vo_bkt in sorted_buckets(cores_bkt.VO):
-            vo = vo_bkt.key
-            for dn_bkt in sorted_buckets(vo_bkt.DN):
-                dn = dn_bkt.key
-                for site_bkt in sorted_buckets(dn_bkt.Site):
-                    site = site_bkt.key
-                    if site == MISSING:
-                        for sitename_bkt in sorted_buckets(site_bkt.SiteName):
-                            sitename = sitename_bkt.key
-                            add_record(recs, vo, sitename, cores, dn,
-                                       sitename_bkt)
-                    else:
-                        add_record(recs, vo, site, cores, dn, site_bkt)
-
-    for rk,rec in sorted(recs.items()):
-        print_rk_recr(year, month, rk, rec, outfile)
+    recs = gracc_apel_records(year, month)
+    hs23_by_site = load_resource_group_map()
+
+    with open(outfile_name, "w", buffering=1<<20) as outfile:
+        print_header(outfile)
+        # The RecordKeys are unique, so sorting on them alone fixes the order
+        for rk in sorted(recs):
+            rec = recs[rk]
+            print_rk_recr(year, month, rk, rec, outfile, hs23_by_site)
 
     print("wrote: %s" % outfile_name)
 
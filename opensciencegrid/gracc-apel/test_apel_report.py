@@ -3,16 +3,50 @@ Testing the apel_report.py script
 
 """
 
+import datetime
+import json
+import os
+import tempfile
+import time
 import unittest
 from io import StringIO
+from unittest import mock
+from opensearchpy import Search
+from opensearchpy.helpers.response import Response
+from opensearchpy.serializer import JSONSerializer
 import apel_report
 
 
+def make_bkt(mintime, maxtime, walldur, cpudur, nf, njobs):
+    """
+    Build a leaf bucket with the metrics requested by add_bkt_metrics
+    """
+    return {
+        "NormalFactor": {"buckets": [{"key": nf}]},
+        "CpuDuration_system": {"value": 0},
+        "CpuDuration_user": {"value": cpudur},
+        "CpuDuration": {"value": cpudur},
+        "WallDuration": {"value": walldur},
+        "NumberOfJobs": {"value": njobs},
+        "EarliestEndTime": {"value": mintime * 1000},
+        "LatestEndTime": {"value": maxtime * 1000},
+    }
+
+
 class TestApelReport(unittest.TestCase):
     """
     Test the apel_report.py script
     """
 
+    def setUp(self):
+        # Keep the resource group cache out of /var/cache/gracc-apel
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        patcher = mock.patch.object(apel_report, "resource_group_cache",
+                                    os.path.join(tmpdir.name, "rg_map.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @staticmethod
     def parse_reports(reports: str) -> list[dict]:
         """
@@ -109,6 +143,178 @@ class TestApelReport(unittest.TestCase):
         self.assertEqual("hepspec-hosts", reports[0]['SubmitHost'])
         self.assertEqual("hepscore-hosts", reports[1]['SubmitHost'])
 
+    def test_print_rk_recr_hs23_portion(self):
+        """
+        Test that the HS23 portion splits the record between submit hosts
+        """
+        rk = apel_report.RecordKey("cms", "Nebraska", 1, "N/A")
+        rec = apel_report.Record(0, 100, 100, 40, 10, 4)
+
+        to_write = StringIO()
+        apel_report.print_rk_recr(2023, 5, rk, rec, to_write, {})
+        reports = self.parse_reports(to_write.getvalue())
+        # parse_reports leaves an empty report after the final separator
+        self.assertEqual(2, len(reports))
+        self.assertEqual({}, reports[-1])
+        self.assertEqual("hepspec-hosts", reports[0]['SubmitHost'])
+        self.assertEqual("generic cms user", reports[0]['GlobalUserName'])
+        self.assertEqual("100", reports[0]['WallDuration'])
+        self.assertEqual("4", reports[0]['NumberOfJobs'])
+
+        to_write = StringIO()
+        apel_report.print_rk_recr(2023, 5, rk, rec, to_write, {"Nebraska": 0.25})
+        reports = self.parse_reports(to_write.getvalue())
+        self.assertEqual(3, len(reports))
+        self.assertEqual({}, reports[-1])
+        self.assertEqual("hepspec-hosts", reports[0]['SubmitHost'])
+        self.assertEqual("75", reports[0]['WallDuration'])
+        self.assertEqual("30", reports[0]['CpuDuration'])
+        self.assertEqual("3", reports[0]['NumberOfJobs'])
+        self.assertEqual("hepscore-hosts", reports[1]['SubmitHost'])
+        self.assertEqual("25", reports[1]['WallDuration'])
+        self.assertEqual("10", reports[1]['CpuDuration'])
+        self.assertEqual("1", reports[1]['NumberOfJobs'])
+
+    def test_reduce_records(self):
+        """
+        Test that rows sharing a RecordKey are summed
+        """
+        rows = [
+            ("cms", "Crane",    1, "dn", make_bkt(10, 20, 100, 50, 10, 1)),
+            ("cms", "Nebraska", 1, "dn", make_bkt(5,  15, 200, 70, 11, 2)),
+            ("cms", "Nebraska", 8, "dn", make_bkt(5,  15, 300, 90, 11, 3)),
+            ("lhcb", "MIT_CMS", 1, "dn", make_bkt(5,  15, 300, 90, 11, 3)),
+        ]
+        recs = apel_report.reduce_records(rows)
+
+        self.assertEqual(3, len(recs))
+        rk = apel_report.RecordKey("cms", "Nebraska", 1, "dn")
+        self.assertEqual(apel_report.Record(5, 20, 300, 120, 10, 3), recs[rk])
+        rk = apel_report.RecordKey("lhcb", "MIT_LHCb", 1, "dn")
+        self.assertIn(rk, recs)
+
+    def test_gracc_query_apel_paging(self):
+        """
+        Test that gracc_query_apel pages through the composite aggregations
+        """
+        searches = []
+
+        def execute(search):
+            # Two pages for the OIM_ResourceGroup scan, one for SiteName
+            request = search.to_dict()
+            searches.append(request)
+            composite = request["aggs"]["apel"]["composite"]
+            site_field = composite["sources"][3]["Site"]["terms"]["field"]
+            if site_field == "OIM_ResourceGroup" and "after" not in composite:
+                count = apel_report.composite_size
+            else:
+                count = 1
+            key = {"Cores": 1, "VO": "cms", "DN": "dn", "Site": site_field}
+            return Response(search, {"aggregations": {"apel": {
+                "buckets": [{"key": key}] * count, "after_key": key}}})
+
+        with mock.patch.object(Search, "execute", execute):
+            rows = list(apel_report.flatten_buckets(apel_report.gracc_query_apel(2023, 5, "cms")))
+
+        self.assertEqual(3, len(searches))
+        self.assertEqual({"Cores": 1, "VO": "cms", "DN": "dn", "Site": "OIM_ResourceGroup"},
+                         searches[1]["aggs"]["apel"]["composite"]["after"])
+        self.assertEqual(apel_report.composite_size + 2, len(rows))
+        self.assertEqual(("cms", "SiteName", 1, "dn"), rows[-1][:4])
+
+    def test_site_name_fallback_kept_apart(self):
+        """
+        Test that a SiteName fallback bucket sharing its name with a
+        resource group is reduced separately from the resource group bucket
+        """
+        searches = []
+
+        def execute(search):
+            request = search.to_dict()
+            searches.append(request)
+            site_field = request["aggs"]["apel"]["composite"]["sources"][3]["Site"]["terms"]["field"]
+            if site_field == "OIM_ResourceGroup":
+                bkt = make_bkt(10, 20, 100, 30, 10, 1)
+            else:
+                # No user/system split, so CpuDuration is used
+                bkt = make_bkt(5, 15, 200, 50, 12, 2)
+                bkt["CpuDuration_user"]["value"] = 0
+            bkt["key"] = {"Cores": 1, "VO": "cms", "DN": "dn", "Site": "MIT_CMS"}
+            return Response(search, {"aggregations": {"apel": {"buckets": [bkt]}}})
+
+        with mock.patch.object(Search, "execute", execute):
+            recs = apel_report.vo_records(2023, 5, "cms")
+
+        rk = apel_report.RecordKey("cms", "MIT_CMS", 1, "dn")
+        self.assertEqual({rk: apel_report.Record(5, 20, 300, 80, 10, 3)}, recs)
+        # Each scan only sees its own records
+        self.assertIn({"exists": {"field": "OIM_ResourceGroup"}},
+                      searches[0]["query"]["bool"]["filter"])
+        self.assertIn({"bool": {"must_not": [{"exists": {"field": "OIM_ResourceGroup"}}]}},
+                      searches[1]["query"]["bool"]["filter"])
+
+    def test_orjson_serializer(self):
+        """
+        Test that the orjson serializer matches the default serializer
+        """
+        serializer = apel_report.ORJSONSerializer()
+        query = {"range": {"EndTime": {"gte": datetime.datetime(2023, 5, 1)}},
+                 "terms": {"VOName": ["cms", "enmr.eu"]}, "size": 0}
+        self.assertEqual(JSONSerializer().dumps(query), serializer.dumps(query))
+        self.assertEqual("{}", serializer.dumps("{}"))
+        self.assertEqual({"aggregations": {"apel": {"buckets": []}}},
+                         serializer.loads('{"aggregations": {"apel": {"buckets": []}}}'))
+
+    def test_resource_group_cache(self):
+        """
+        Test the on-disk cache of the resource group map
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = os.path.join(tmpdir, "rg_map.json")
+            with open(cache, "w") as f:
+                json.dump({"Nebraska": 0.5}, f)
+
+            with mock.patch.object(apel_report, "resource_group_cache", cache), \
+                 mock.patch.object(apel_report, "resource_group_map", None), \
+                 mock.patch.object(apel_report, "download_resource_group_map") as download:
+                # A fresh cache is used without contacting Topology
+                self.assertEqual(0.5, apel_report.get_hs23_portion("Nebraska"))
+                self.assertEqual(0.0, apel_report.get_hs23_portion("Unknown"))
+                download.assert_not_called()
+
+            # An expired cache is used as a fallback when Topology is down
+            expired = time.time() - apel_report.resource_group_cache_ttl - 60
+            os.utime(cache, (expired, expired))
+            with mock.patch.object(apel_report, "resource_group_cache", cache), \
+                 mock.patch.object(apel_report, "resource_group_map", None), \
+                 mock.patch.object(apel_report, "download_resource_group_map",
+                                   side_effect=Exception("Topology is down")) as download:
+                self.assertEqual(0.5, apel_report.get_hs23_portion("Nebraska"))
+                download.assert_called_once()
+
+            # ... but not once it is older than the maximum stale age
+            os.utime(cache, (0, 0))
+            with mock.patch.object(apel_report, "resource_group_cache", cache), \
+                 mock.patch.object(apel_report, "resource_group_map", None), \
+                 mock.patch.object(apel_report, "download_resource_group_map",
+                                   side_effect=Exception("Topology is down")):
+                self.assertRaises(Exception, apel_report.get_hs23_portion, "Nebraska")
+
+            # A cache that does not hold a map is a cache miss
+            with open(cache, "w") as f:
+                json.dump([], f)
+            with mock.patch.object(apel_report, "resource_group_cache", cache):
+                self.assertIsNone(apel_report.load_resource_group_cache(
+                    apel_report.resource_group_cache_ttl))
+
+            # A successful download refreshes the cache
+            with mock.patch.object(apel_report, "resource_group_cache", cache), \
+                 mock.patch.object(apel_report, "resource_group_map", None), \
+                 mock.patch.object(apel_report, "download_resource_group_map",
+                                   return_value={"Nebraska": 0.25}):
+                self.assertEqual(0.25, apel_report.get_hs23_portion("Nebraska"))
+                self.assertEqual({"Nebraska": 0.25}, apel_report.load_resource_group_cache(
+                    apel_report.resource_group_cache_ttl))
 
 
 if __name__ == '__main__':